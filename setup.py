@@ -62,6 +62,7 @@ setup(
     python_requires='>=3.6',
     install_requires=[
         'tornado', 'traitlets', 'notebook', 'ipython_genutils', 'nbformat',
-        'pyarrow'  # HDFS Support
+        'cachetools',  # HDFS metadata cache
+        'pyarrow>=2.0'  # HDFS Support
     ]
 )
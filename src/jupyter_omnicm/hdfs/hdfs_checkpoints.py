@@ -1,12 +1,14 @@
 """
 HDFS-based Checkpoints implementations.
 """
-import os
+import posixpath
 
 from notebook import _tz as tz
 from notebook.services.contents.checkpoints import Checkpoints
-from pyarrow.hdfs import HadoopFileSystem
+from pyarrow.fs import HadoopFileSystem
+from tornado import web
 from tornado.httpclient import HTTPError
+from traitlets import Integer
 from traitlets import Unicode
 
 from .hdfs_io import HDFSManagerMixin
@@ -29,6 +31,15 @@ class HDFSCheckpoints(HDFSManagerMixin, Checkpoints):
         """,
     )
 
+    copy_buffer_size = Integer(
+        1 << 20,
+        config=True,
+        help="""The buffer size, in bytes, used when copying a file to or from
+        its checkpoint. Larger values mean fewer round trips to the DataNodes.
+        By default, it is 1 MiB
+        """,
+    )
+
     fs: HadoopFileSystem = None
     root_dir = None
 
@@ -38,7 +49,15 @@ class HDFSCheckpoints(HDFSManagerMixin, Checkpoints):
         checkpoint_id = u'checkpoint'
         dest_path = self.checkpoint_path(checkpoint_id, path)
         fs_dest_path = self._to_fs_path(dest_path)
+        fs_cp_dir = fs_dest_path.rsplit('/', 1)[0]
+        info, cp_dir_info = self._stat_many([fs_path, fs_cp_dir])
+        if info is None:
+            raise web.HTTPError(404, f'File does not exist: {path}')
+        if cp_dir_info is None:
+            with self.perm_to_403():
+                self.fs.create_dir(fs_cp_dir, recursive=False)
         self.__fs_copy(fs_path, fs_dest_path)
+        self._invalidate_info(fs_dest_path)
         return self.checkpoint_model(checkpoint_id, dest_path)
 
     def restore_checkpoint(self, contents_mgr, checkpoint_id, path):
@@ -47,31 +66,40 @@ class HDFSCheckpoints(HDFSManagerMixin, Checkpoints):
         src_path = self.checkpoint_path(checkpoint_id, path)
         fs_src_path = self._to_fs_path(src_path)
         self.__fs_copy(fs_src_path, fs_path)
+        self._invalidate_info(fs_path)
 
     def rename_checkpoint(self, checkpoint_id, old_path, new_path):
         """Rename a checkpoint from old_path to new_path."""
         old_cp_path = self.checkpoint_path(checkpoint_id, old_path)
-        fs_old_cp_path = self._to_api_path(old_cp_path)
+        fs_old_cp_path = self._to_fs_path(old_cp_path)
         new_cp_path = self.checkpoint_path(checkpoint_id, new_path)
-        fs_new_cp_path = self._to_api_path(new_cp_path)
-        if self.fs.exists(fs_old_cp_path):
-            self.log.info(
-                "Renaming checkpoint %s -> %s",
-                old_cp_path,
-                new_cp_path,
-            )
-            with self.perm_to_403():
-                self.fs.rename(fs_old_cp_path, fs_new_cp_path)
+        fs_new_cp_path = self._to_fs_path(new_cp_path)
+        fs_new_cp_dir = fs_new_cp_path.rsplit('/', 1)[0]
+        old_cp_info, new_cp_dir_info = self._stat_many([fs_old_cp_path, fs_new_cp_dir])
+        if old_cp_info is None:
+            # No checkpoint to rename.
+            return
+        with self.perm_to_403():
+            if new_cp_dir_info is None:
+                self.fs.create_dir(fs_new_cp_dir, recursive=False)
+            self.fs.move(fs_old_cp_path, fs_new_cp_path)
+        self.log.info(
+            "Renamed checkpoint %s -> %s",
+            old_cp_path,
+            new_cp_path,
+        )
+        self._invalidate_info(fs_old_cp_path, fs_new_cp_path)
 
     def delete_checkpoint(self, checkpoint_id, path):
         """delete a file's checkpoint"""
         cp_path = self.checkpoint_path(checkpoint_id, path)
         fs_cp_path = self._to_fs_path(cp_path)
-        if not self.fs.exists(fs_cp_path):
+        if self._stat(fs_cp_path) is None:
             raise HTTPError(404, f'Checkpoint does not exist: {path}@{checkpoint_id}')
         self.log.info("Removing checkpoint %s", cp_path)
         with self.perm_to_403():
-            self.fs.delete(fs_cp_path)
+            self.fs.delete_file(fs_cp_path)
+        self._invalidate_info(fs_cp_path)
 
     def list_checkpoints(self, path):
         """list the checkpoints for a given file
@@ -80,34 +108,32 @@ class HDFSCheckpoints(HDFSManagerMixin, Checkpoints):
         checkpoint_id = u'checkpoint'
         cp_path = self.checkpoint_path(checkpoint_id, path)
         fs_cp_path = self._to_fs_path(cp_path)
-        if not self.fs.exists(fs_cp_path):
+        info = self._stat(fs_cp_path)
+        if info is None:
             return []
         else:
-            return [self.checkpoint_model(checkpoint_id, cp_path)]
+            return [self.checkpoint_model(checkpoint_id, cp_path, info)]
 
     def checkpoint_path(self, checkpoint_id, path):
-        """find the path to a checkpoint"""
-        path = path.strip('/')
-        parent, name = ('/' + path).rsplit('/', 1)
-        parent = parent.strip('/')
-        basename, ext = os.path.splitext(name)
-        filename = u"{name}-{checkpoint_id}{ext}".format(
-            name=basename,
-            checkpoint_id=checkpoint_id,
-            ext=ext,
-        )
-        cp_dir = os.path.join(parent, self.checkpoint_dir)
-        fs_cp_dir = self._to_fs_path(cp_dir)
-        with self.perm_to_403():
-            self.fs.exists(fs_cp_dir) and self.fs.isdir(fs_cp_dir)
-        cp_path = os.path.join(cp_dir, filename)
-        return cp_path
+        """find the path to a checkpoint
 
-    def checkpoint_model(self, checkpoint_id, path):
-        """construct the info dict for a given checkpoint"""
-        fs_path = self._to_fs_path(path)
-        stats = self.fs.info(fs_path)
-        last_modified = tz.utcfromtimestamp(stats[u'last_modified'])
+        This only computes the API path, it does not query HDFS.
+        create_checkpoint is responsible for creating the checkpoint directory.
+        """
+        parent, _, name = path.strip('/').rpartition('/')
+        basename, ext = posixpath.splitext(name)
+        filename = f"{basename}-{checkpoint_id}{ext}"
+        return posixpath.join(parent, self.checkpoint_dir, filename)
+
+    def checkpoint_model(self, checkpoint_id, path, stats=None):
+        """construct the info dict for a given checkpoint
+
+        stats is the HDFS info of the checkpoint, when already known.
+        """
+        if stats is None:
+            fs_path = self._to_fs_path(path)
+            stats = self._info_cached(fs_path)
+        last_modified = tz.utcfromtimestamp(stats.mtime_ns / 1e9)
 
         info = dict(
             id=checkpoint_id,
@@ -115,7 +141,7 @@ class HDFSCheckpoints(HDFSManagerMixin, Checkpoints):
         )
         return info
 
-    def __fs_copy(self, fs_src, fs_dst, mode=0o0770, chunk_size=2**16):
+    def __fs_copy(self, fs_src, fs_dst, chunk_size=None):
         """Copy a file.
 
         Parameters
@@ -126,17 +152,12 @@ class HDFSCheckpoints(HDFSManagerMixin, Checkpoints):
         fs_dst: string
             Path of destination file on HDFS
 
-        mode: integer, optional
-            Permissions to apply to the destination file. Default 0770.
-
         chunk_size: integer, optional
-            Copy chunk size to use when doing the copy. Default 2**16.
+            Copy chunk size to use when doing the copy. Default copy_buffer_size.
         """
-        with self.fs.open(fs_dst, mode='wb') as f1:
-            with self.fs.open(fs_src, mode='rb') as f2:
-                while True:
-                    out = f2.read(chunk_size)
-                    if len(out) == 0:
-                        break
-                    f1.write(out)
-        self.fs.chmod(fs_dst, mode)
+        if chunk_size is None:
+            chunk_size = self.copy_buffer_size
+        # The source is opened first, so that fs_dst is not truncated when fs_src is missing.
+        with self.fs.open_input_stream(fs_src, compression=None) as f1:
+            with self.fs.open_output_stream(fs_dst, compression=None) as f2:
+                self._copy_stream(f1, f2, chunk_size)
@@ -2,19 +2,76 @@
 Utilities for HDFS-based Contents/Checkpoints managers.
 """
 
-import os
-import tempfile
+import queue
+import threading
 import uuid
-from base64 import decodebytes
-from base64 import encodebytes
+from base64 import b64decode
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import lru_cache
 
 import nbformat
+from cachetools import TTLCache
 from notebook.utils import to_api_path
 from notebook.utils import to_os_path
+from pyarrow.fs import FileType
 from tornado.web import HTTPError
+from traitlets import Float
+from traitlets import Instance
+from traitlets import Integer
+from traitlets import default
 from traitlets.config import Configurable
 
+# Files larger than this are read as several ranges in parallel.
+PARALLEL_READ_THRESHOLD = 16 << 20
+# Size of each range read in parallel.
+PARALLEL_READ_CHUNK_SIZE = 8 << 20
+
+# Base64 content longer than this is decoded and written chunk by chunk.
+# Must be a multiple of 4 characters.
+B64_DECODE_CHUNK_SIZE = 4 << 20
+
+# Metadata caches are shared by request threads, guard every access.
+_meta_cache_lock = threading.RLock()
+
+# Bulk range reads, metadata lookups and copy readers get their own pools,
+# so that small NameNode requests never wait behind large DataNode transfers.
+_worker_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hdfscm-worker')
+_stat_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hdfscm-stat')
+_copy_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hdfscm-copy')
+
+# API to HDFS path conversions only depend on their arguments, memoize them.
+_cached_to_os_path = lru_cache(maxsize=2048)(to_os_path)
+
+
+def _iter_b64decode(content, chunk_size=B64_DECODE_CHUNK_SIZE):
+    """Decode base64 content chunk by chunk, ignoring line breaks."""
+    remainder = ''
+    for start in range(0, len(content), chunk_size):
+        chunk = remainder + ''.join(content[start:start + chunk_size].split())
+        end = len(chunk) - len(chunk) % 4
+        remainder = chunk[end:]
+        yield b64decode(chunk[:end])
+    if remainder:
+        yield b64decode(remainder)
+
+
+def _fill_buffers(src, free, filled):
+    """Read src into the buffers taken from free and hand them over to filled, until EOF."""
+    try:
+        while True:
+            buf = free.get()
+            if buf is None:
+                return
+            size = src.readinto(buf)
+            filled.put((buf, size))
+            if size == 0:
+                return
+    except BaseException:
+        filled.put((None, 0))
+        raise
+
 
 class HDFSManagerMixin(Configurable):
     """
@@ -38,6 +95,108 @@ class HDFSManagerMixin(Configurable):
     log : logging.Logger
     """
 
+    meta_cache_ttl = Float(
+        2.0,
+        config=True,
+        help="""Seconds during which HDFS metadata is reused before asking the NameNode again.
+        By default, it is 2 seconds
+        """,
+    )
+
+    meta_cache_size = Integer(
+        4096,
+        config=True,
+        help="""Maximum number of HDFS paths whose metadata is cached.
+        By default, it is 4096
+        """,
+    )
+
+    missing_cache_ttl = Float(
+        0.5,
+        config=True,
+        help="""Seconds during which a path is remembered as missing before asking the NameNode again.
+        By default, it is 0.5 second
+        """,
+    )
+
+    _meta_cache = Instance(TTLCache)
+    _missing_cache = Instance(TTLCache)
+
+    @default('_meta_cache')
+    def _default_meta_cache(self):
+        # Checkpoints share the cache of the contents manager they belong to.
+        if isinstance(self.parent, HDFSManagerMixin):
+            return self.parent._meta_cache
+        return TTLCache(maxsize=self.meta_cache_size, ttl=self.meta_cache_ttl)
+
+    @default('_missing_cache')
+    def _default_missing_cache(self):
+        if isinstance(self.parent, HDFSManagerMixin):
+            return self.parent._missing_cache
+        return TTLCache(maxsize=self.meta_cache_size, ttl=self.missing_cache_ttl)
+
+    def _cache_get(self, fs_path):
+        """Return the cached FileInfo of a path, possibly a NotFound one, or None."""
+        with _meta_cache_lock:
+            info = self._meta_cache.get(fs_path)
+            if info is None:
+                info = self._missing_cache.get(fs_path)
+        return info
+
+    def _cache_put(self, fs_path, info):
+        """Cache the FileInfo of a path, missing paths are kept for a shorter time."""
+        with _meta_cache_lock:
+            if info.type == FileType.NotFound:
+                self._missing_cache[fs_path] = info
+            else:
+                self._meta_cache[fs_path] = info
+
+    def _info_cached(self, fs_path):
+        """Return the HDFS FileInfo of a path, reusing a recent one if available."""
+        info = self._cache_get(fs_path)
+        if info is None:
+            info = self.fs.get_file_info(fs_path)
+            self._cache_put(fs_path, info)
+        return info
+
+    def _stat_many(self, fs_paths):
+        """Like _stat, for several paths at once.
+
+        Paths missing from the metadata cache are looked up concurrently.
+        """
+        infos = {fs_path: self._cache_get(fs_path) for fs_path in fs_paths}
+        futures = {fs_path: _stat_pool.submit(self.fs.get_file_info, fs_path)
+                   for fs_path, info in infos.items() if info is None}
+        for fs_path, future in futures.items():
+            try:
+                info = future.result()
+            except OSError:
+                continue
+            self._cache_put(fs_path, info)
+            infos[fs_path] = info
+        return [None if info is None or info.type == FileType.NotFound else info
+                for info in (infos[fs_path] for fs_path in fs_paths)]
+
+    def _invalidate_info(self, *fs_paths):
+        """Forget the cached info of paths, of their children and of their parent directory."""
+        with _meta_cache_lock:
+            for cache in (self._meta_cache, self._missing_cache):
+                for fs_path in fs_paths:
+                    prefix = fs_path.rstrip('/') + '/'
+                    for key in [key for key in cache if key == fs_path or key.startswith(prefix)]:
+                        cache.pop(key, None)
+                    cache.pop(fs_path.rstrip('/').rsplit('/', 1)[0], None)
+
+    def _stat(self, fs_path):
+        """Return the HDFS FileInfo of a path, or None if it does not exist."""
+        try:
+            info = self._info_cached(fs_path)
+        except OSError:
+            return None
+        if info.type == FileType.NotFound:
+            return None
+        return info
+
     def _to_fs_path(self, path):
         """Given an API path, return its HDFS path.
 
@@ -55,7 +214,7 @@ class HDFSManagerMixin(Configurable):
         ------
         404: if path is outside root
         """
-        fs_path = to_os_path(path, self.root_dir)
+        fs_path = _cached_to_os_path(path, self.root_dir)
         if not fs_path.startswith(self.root_dir):
             raise HTTPError(404, "%s is outside root contents directory" % path)
         return fs_path
@@ -83,22 +242,80 @@ class HDFSManagerMixin(Configurable):
         except (OSError, IOError) as e:
             raise HTTPError(403, f'Permission denied {e}')
 
+    def _copy_stream(self, src, dst, chunk_size):
+        """Copy src to dst, reading the next chunk while the current one is written.
+
+        Two buffers of chunk_size bytes are reused for the whole copy.
+        """
+        free = queue.Queue()
+        filled = queue.Queue()
+        for _ in range(2):
+            free.put(bytearray(chunk_size))
+        reader = _copy_pool.submit(_fill_buffers, src, free, filled)
+        try:
+            while True:
+                buf, size = filled.get()
+                if size == 0:
+                    break
+                dst.write(memoryview(buf)[:size])
+                free.put(buf)
+        finally:
+            # Stops the reader if writing failed.
+            free.put(None)
+            reader.result()
+
+    def _read_range(self, fs_path, offset, length):
+        """Read length bytes of a HDFS file, starting at offset."""
+        with self.fs.open_input_file(fs_path) as fp:
+            return fp.read_at(length, offset)
+
+    def _parallel_read(self, fs_path, size, chunk_size=PARALLEL_READ_CHUNK_SIZE):
+        """Read a whole HDFS file by fetching its ranges concurrently.
+
+        Parameters
+        ----------
+        fs_path : string
+            The HDFS path of the file.
+
+        size : integer
+            The size of the file in bytes.
+
+        chunk_size : integer, optional
+            The size of each range. Default PARALLEL_READ_CHUNK_SIZE.
+        """
+        futures = [_worker_pool.submit(self._read_range, fs_path, offset, min(chunk_size, size - offset))
+                   for offset in range(0, size, chunk_size)]
+        return b''.join(future.result() for future in futures)
+
+    def _read_bytes(self, fs_path):
+        """Read the whole content of a HDFS file.
+
+        Large files are read with several concurrent streams, small ones with a single one.
+        """
+        with self.fs.open_input_file(fs_path) as fp:
+            # The size comes from the opened file, cached metadata may predate an append.
+            size = fp.size()
+            if size <= PARALLEL_READ_THRESHOLD:
+                return fp.read()
+        return self._parallel_read(fs_path, size)
+
     def _ensure_path_is_valid(self, path, type=None, enforce_exists=False):
         if self.is_hidden(path):
             raise HTTPError(400, f'Invalid hidden file/directory: {path}')
         fs_path = self._to_fs_path(path)
-        if self.fs.exists(fs_path):
+        info = self._stat(fs_path)
+        if info is not None:
             if type is not None:
                 if type in ('file', 'notebook'):
-                    if self.fs.isdir(fs_path):
+                    if info.type == FileType.Directory:
                         raise HTTPError(400, f'Not a file: {path}')
                 else:
-                    if self.fs.isfile(fs_path):
+                    if info.type == FileType.File:
                         raise HTTPError(400, f'Not a directory: {path}')
         elif enforce_exists:
             raise HTTPError(400, f'{path} does not exist')
 
-    def _save_directory(self, path, mode=0o0770):
+    def _save_directory(self, path, _validated=False):
         """Create a directory.
 
         Parameters
@@ -106,24 +323,27 @@ class HDFSManagerMixin(Configurable):
         path : string
             The API path of the directory.
 
+        _validated: boolean, optional
+            Whether the caller already ran _ensure_path_is_valid on path. Default False.
+
         Raises
         ------
         400: if path is a hidden directory, if directory is already exists or if it is not a directory
         403: if permission is denied
         """
-        if self.is_hidden(path):
+        if not _validated and self.is_hidden(path):
             raise HTTPError(400, f'Cannot create hidden directory {path}')
         fs_path = self._to_fs_path(path)
-        if self.fs.exists(fs_path):
-            if self.fs.isfile(fs_path):
+        info = self._stat(fs_path)
+        if info is not None:
+            if info.type == FileType.File:
                 raise HTTPError(400, f'Not a directory: {path}')
             else:
                 raise HTTPError(400, f'Directory {path} already exists')
         with self.perm_to_403():
-            self.fs.mkdir(fs_path)
-            self.fs.chmod(fs_path, mode)
+            self.fs.create_dir(fs_path, recursive=False)
 
-    def _save_file(self, path, content, format):
+    def _save_file(self, path, content, format, _validated=False):
         """Save content in a file, creating it if needed.
 
         Parameters
@@ -137,6 +357,9 @@ class HDFSManagerMixin(Configurable):
         format: string
             The format of the content. Can be either 'text' or 'base64'
 
+        _validated: boolean, optional
+            Whether the caller already ran _ensure_path_is_valid on path. Default False.
+
         Raises
         ------
         400: if format has invalid parameter. if path is a hidden file, if file already exists but is a directory
@@ -144,24 +367,45 @@ class HDFSManagerMixin(Configurable):
         """
         if format not in {'text', 'base64'}:
             raise HTTPError(400, "Must specify format of file contents as 'text' or 'base64'")
-        self._ensure_path_is_valid(path, 'file')
+        if not _validated:
+            self._ensure_path_is_valid(path, 'file')
         fs_path = self._to_fs_path(path)
+        write_path = fs_path
+        if format == 'base64' and len(content) > B64_DECODE_CHUNK_SIZE:
+            # Large uploads are decoded while being written, to bound memory usage.
+            # They go to a hidden temporary file first so that invalid content cannot clobber fs_path.
+            bchunks = _iter_b64decode(content)
+            parent, _, name = fs_path.rpartition('/')
+            write_path = f'{parent}/.{name}.{uuid.uuid4().hex}.upload'
+        else:
+            try:
+                if format == 'text':
+                    bchunks = [content.encode('utf8')]
+                else:
+                    bchunks = [b64decode(content)]
+            except Exception as e:
+                raise HTTPError(400, f'Content encoding error for {path} {e}')
         try:
-            if format == 'text':
-                bcontent = content.encode('utf8')
-            else:
-                b64_bytes = content.encode('ascii')
-                bcontent = decodebytes(b64_bytes)
-        except Exception as e:
-            raise HTTPError(400, f'Content encoding error for {path} {e}')
-        with self.perm_to_403():
-            with self.fs.open(fs_path, 'wb') as fp:
+            with self.perm_to_403():
+                with self.fs.open_output_stream(write_path, compression=None) as fp:
+                    try:
+                        for bcontent in bchunks:
+                            fp.write(bcontent)
+                    except ValueError as e:
+                        raise HTTPError(400, f'Content encoding error for {path} {e}')
+                    except Exception as e:
+                        raise HTTPError(400, f"Unwritable file: {path} {e}")
+                if write_path != fs_path:
+                    self.fs.move(write_path, fs_path)
+        except Exception:
+            if write_path != fs_path:
                 try:
-                    fp.write(bcontent)
-                except Exception as e:
-                    raise HTTPError(400, f"Unwritable file: {path} {e}")
+                    self.fs.delete_file(write_path)
+                except OSError:
+                    pass
+            raise
 
-    def _save_notebook(self, path, nb, as_version=nbformat.NO_CONVERT):
+    def _save_notebook(self, path, nb, as_version=nbformat.NO_CONVERT, _validated=False):
         """Save a notebook in a file, creating it if needed.
 
         Parameters
@@ -175,26 +419,31 @@ class HDFSManagerMixin(Configurable):
         as_version: string
             The format of the notebook. Defaults to NO_CONVERT.
 
+        _validated: boolean, optional
+            Whether the caller already ran _ensure_path_is_valid on path. Default False.
+
         Raises
         ------
         400: if path is a hidden file, if file already exists but is a directory
         403: if permission is denied
         """
-        self._ensure_path_is_valid(path, 'file')
+        if not _validated:
+            self._ensure_path_is_valid(path, 'file')
         fs_path = self._to_fs_path(path)
-        tempdir = tempfile.mkdtemp()
-        filename = f'{tempdir}/{uuid.uuid4()}'
         try:
-            with open(filename, mode='w+', encoding='utf-8') as fp:
-                nbformat.write(nb, fp, as_version)
-            with self.perm_to_403():
-                with open(filename, mode='rb') as fp:
-                    self.fs.upload(fs_path, fp)
-            os.unlink(filename)
+            s = nbformat.writes(nb, as_version)
+            # Like nbformat.write, end the file with a newline.
+            if not s.endswith('\n'):
+                s += '\n'
+            bcontent = s.encode('utf8')
         except Exception as e:
-            if os.path.exists(filename):
-                os.unlink(filename)
             raise HTTPError(400, f"Unwritable Notebook: {path} {e}")
+        with self.perm_to_403():
+            with self.fs.open_output_stream(fs_path, compression=None) as fp:
+                try:
+                    fp.write(bcontent)
+                except Exception as e:
+                    raise HTTPError(400, f"Unwritable Notebook: {path} {e}")
 
     def _read_notebook(self, path, as_version=4):
         """Read a notebook from a path.
@@ -215,11 +464,12 @@ class HDFSManagerMixin(Configurable):
         self._ensure_path_is_valid(path, 'file', enforce_exists=True)
         fs_path = self._to_fs_path(path)
         with self.perm_to_403():
-            with self.fs.open(fs_path, 'rb') as fp:
-                try:
-                    return nbformat.reads(fp.read(), as_version)
-                except Exception as e:
-                    raise HTTPError(400, f"Unreadable file: {path} {e}")
+            bcontent = self._read_bytes(fs_path)
+        try:
+            # json parses UTF-8 bytes directly, no need for a decoded copy.
+            return nbformat.reads(bcontent, as_version)
+        except Exception as e:
+            raise HTTPError(400, f"Unreadable file: {path} {e}")
 
     def _read_file(self, path, format):
         """Read a non-notebook file.
@@ -246,16 +496,19 @@ class HDFSManagerMixin(Configurable):
         self._ensure_path_is_valid(path, 'file', enforce_exists=True)
         fs_path = self._to_fs_path(path)
         with self.perm_to_403():
-            with self.fs.open(fs_path, 'rb') as fp:
+            bcontent = self._read_bytes(fs_path)
+        try:
+            if format == 'base64':
+                return b64encode(bcontent).decode('ascii'), 'base64'
+            if format == 'text':
                 try:
-                    bcontent = fp.readall()
-                    # Try to interpret as unicode if format is unknown or if unicode
-                    # was explicitly requested.
-                    try:
-                        return bcontent.decode('utf8'), 'text'
-                    except UnicodeError:
-                        if format == 'text':
-                            raise HTTPError(400, f"{path} is not UTF-8 encoded")
-                    return encodebytes(bcontent).decode('ascii'), 'base64'
-                except Exception as e:
-                    raise HTTPError(400, f"Unreadable file: {path} {e}")
+                    return bcontent.decode('utf8'), 'text'
+                except UnicodeError:
+                    raise HTTPError(400, f"{path} is not UTF-8 encoded")
+            # Format is unknown, try to interpret as unicode and fall back to base64.
+            try:
+                return bcontent.decode('utf8'), 'text'
+            except UnicodeError:
+                return b64encode(bcontent).decode('ascii'), 'base64'
+        except Exception as e:
+            raise HTTPError(400, f"Unreadable file: {path} {e}")
@@ -1,11 +1,20 @@
 """ A content manager that uses the HDFS File system for storage. """
+import getpass
 import mimetypes
+import posixpath
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from contextlib import contextmanager
+from functools import lru_cache
 
 import nbformat
-import pyarrow as pa
 from notebook import _tz as tz
 from notebook.services.contents.manager import ContentsManager
-from pyarrow.hdfs import HadoopFileSystem
+from pyarrow.fs import FileSelector
+from pyarrow.fs import FileType
+from pyarrow.fs import HadoopFileSystem
 from tornado import web
 from traitlets import Dict
 from traitlets import Instance
@@ -18,6 +27,32 @@ from .hdfs_io import HDFSManagerMixin
 
 _script_exporter = None
 
+_connections = {}
+
+# Marks the threads of the I/O pool, see HDFSContentsManager._run_blocking.
+_io_thread = threading.local()
+
+# HDFS grants a single writer lease per file, writes to the same path are serialized.
+# Reentrant, as a save creates the notebook's first checkpoint while holding its lock.
+_path_locks = weakref.WeakValueDictionary()
+_path_locks_lock = threading.Lock()
+
+
+def _connect(host, port, user, kerb_ticket, extra_conf):
+    """Return the HDFS connection for these parameters, shared by the whole process."""
+    key = (host, port, user, kerb_ticket, tuple(sorted(extra_conf.items())))
+    fs = _connections.get(key)
+    if fs is None:
+        fs = _connections[key] = HadoopFileSystem(host=host, port=port, user=user, kerb_ticket=kerb_ticket,
+                                                  extra_conf=extra_conf or None)
+    return fs
+
+
+@lru_cache(maxsize=4096)
+def _is_hidden_api_path(path):
+    """Whether any component of an API path starts with a dot."""
+    return any(part.startswith('.') for part in path.strip('/').split('/'))
+
 
 class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
 
@@ -26,20 +61,23 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
     user: str = Unicode(u'', config=True, help='Username when connecting to HDFS; None implies login user. Default None.')
     kerb_ticket: str = Unicode(u'', config=True, help='Path to Kerberos ticket cache. Default None.')
     driver: str = Unicode(u'libhdfs', config=True,
-                          help="Connect using 'libhdfs' (JNI-based) or 'libhdfs3' (3rd-party C++ library). Default 'libhdfs'.")
+                          help="Deprecated, pyarrow only supports 'libhdfs' (JNI-based). Default 'libhdfs'.")
     extra_conf: dict = Dict(
         {}, config=True, help='extra Key/Value pairs for config; Will override any hdfs-site.xml properties. Default None.')
     fs: HadoopFileSystem = Instance(HadoopFileSystem, config=True,
                                     help="HDFS connection. Setup automatically based on the other parameters. Do not set manually.")
     root_dir: str = Unicode(config=True)
+    io_threads: int = Integer(32, config=True,
+                              help='Number of threads running blocking HDFS operations off the IOLoop. Default 32.')
+    _io_pool = Instance(ThreadPoolExecutor)
 
     @default('root_dir')
     def _default_root_dir(self):
-        try:
-            nb_dir = self.parent.notebook_dir
-            return self.fs.info(nb_dir)['path']
-        except pa.lib.ArrowIOError:
-            return self.fs.info('.')['path']
+        nb_dir = self.parent.notebook_dir
+        if self.fs.get_file_info(nb_dir).type == FileType.Directory:
+            return nb_dir
+        # Fall back to the user's home directory on HDFS.
+        return posixpath.join('/user', self.user or getpass.getuser())
 
     @default('fs')
     def _default_fs(self):
@@ -49,8 +87,49 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
         kerb_ticket = self.kerb_ticket
         if len(kerb_ticket) == 0:
             kerb_ticket = None
-        return pa.hdfs.connect(host=self.host, port=self.port, user=user, kerb_ticket=kerb_ticket,
-                               driver=self.driver, extra_conf=self.extra_conf)
+        if self.driver != 'libhdfs':
+            self.log.warning(f"Ignoring HDFS driver {self.driver}, pyarrow only supports libhdfs")
+        return _connect(self.host, self.port, user, kerb_ticket, self.extra_conf)
+
+    @default('_io_pool')
+    def _default_io_pool(self):
+        return ThreadPoolExecutor(max_workers=self.io_threads, thread_name_prefix='hdfscm-io')
+
+    def _run_blocking(self, fn, *args, **kwargs):
+        """Run fn on the I/O pool and return a future of its result.
+
+        The notebook handlers wrap the result with maybe_future, so the IOLoop is not blocked
+        by NameNode and DataNode round trips. Calls made from within the pool run inline,
+        so that composite operations still get plain results from the methods they call.
+        """
+        if getattr(_io_thread, 'active', False):
+            return fn(*args, **kwargs)
+        return self._io_pool.submit(self._run_on_io_thread, fn, *args, **kwargs)
+
+    @staticmethod
+    def _run_on_io_thread(fn, *args, **kwargs):
+        _io_thread.active = True
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _io_thread.active = False
+
+    @contextmanager
+    def _path_lock(self, *paths):
+        """Hold the write locks of the given API paths, always taken in the same order."""
+        with ExitStack() as stack:
+            for fs_path in sorted({self._to_fs_path(path) for path in paths}):
+                with _path_locks_lock:
+                    lock = _path_locks.get(fs_path)
+                    if lock is None:
+                        lock = _path_locks[fs_path] = threading.RLock()
+                stack.enter_context(lock)
+            yield
+
+    def _run_locked(self, paths, fn, *args):
+        """Call fn while holding the write locks of paths."""
+        with self._path_lock(*paths):
+            return fn(*args)
 
     def _checkpoints_class_default(self):
         HDFSCheckpoints.fs = self.fs
@@ -73,7 +152,8 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
             Whether the path does indeed exist.
         """
         fs_path = self._to_fs_path(path)
-        return self.fs.exists(fs_path) and self.fs.isdir(fs_path)
+        info = self._stat(fs_path)
+        return info is not None and info.type == FileType.Directory
 
     def is_hidden(self, path):
         """Is path a hidden directory or file?
@@ -90,8 +170,7 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
             Whether the path is hidden.
 
         """
-        fs_path = self._to_fs_path(path)
-        return any(part.startswith('.') for part in fs_path.split('/'))
+        return _is_hidden_api_path(path)
 
     def file_exists(self, path=''):
         """Does a file exist at the given path?
@@ -111,15 +190,21 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
             Whether the file exists.
         """
         fs_path = self._to_fs_path(path)
-        return self.fs.exists(fs_path) and self.fs.isfile(fs_path)
+        info = self._stat(fs_path)
+        return info is not None and info.type == FileType.File
 
     def __base_model(self, path, type):
         """Build the common base of a model"""
         self._ensure_path_is_valid(path, type, enforce_exists=True)
         fs_path = self._to_fs_path(path)
-        info = self.fs.info(fs_path)
-        last_modified = tz.utcfromtimestamp(info[u'last_modified'])
-        created = tz.utcfromtimestamp(info[u'last_accessed'])
+        info = self._info_cached(fs_path)
+        return self._base_model_from_info(info, path)
+
+    def _base_model_from_info(self, info, path):
+        """Build the common base of a model from an HDFS FileInfo"""
+        last_modified = tz.utcfromtimestamp(info.mtime_ns / 1e9)
+        # HDFS does not expose a creation time.
+        created = last_modified
         model = {}
         model['name'] = path.rsplit('/', 1)[-1]
         model['path'] = path
@@ -128,13 +213,9 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
         model['content'] = None
         model['format'] = None
         model['mimetype'] = None
-        model['type'] = info[u'kind']
-
-        try:
-            model['writable'] = (info[u'permissions'] & 0o0200) > 0
-        except OSError:
-            self.log.error(f"Failed to check write permissions on {path}")
-            model['writable'] = False
+        model['type'] = 'directory' if info.type == FileType.Directory else 'file'
+        # pyarrow does not expose HDFS permissions, denied writes are reported as 403 instead.
+        model['writable'] = True
         return model
 
     def __get_dir(self, path, content=True):
@@ -145,12 +226,17 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
         fs_path = self._to_fs_path(path)
         if content:
             model['content'] = contents = []
-            for subpath in self.fs.ls(fs_path):
-                name = subpath.strip('/').rsplit('/', 1)[-1]
-                if self.should_list(name) and not self.is_hidden(subpath):
-                    contents.append(self.get(
-                        path='%s/%s' % (path, name),
-                        content=False))
+            # A listing returns every entry's info in a single RPC.
+            for info in self.fs.get_file_info(FileSelector(fs_path)):
+                name = info.base_name
+                if not self.should_list(name) or name.startswith('.'):
+                    continue
+                child = self._base_model_from_info(info, '%s/%s' % (path, name))
+                if info.type == FileType.File and name.endswith('.ipynb'):
+                    child['type'] = 'notebook'
+                elif child['type'] == 'file':
+                    child['mimetype'] = mimetypes.guess_type(name)[0]
+                contents.append(child)
             model['format'] = 'json'
         return model
 
@@ -197,10 +283,10 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
         """Get a file or directory model."""
         if not type:  # Infers the type if not specified.
             fs_path = self._to_fs_path(path)
-            if not self.fs.exists(fs_path):
+            info = self._stat(fs_path)
+            if info is None:
                 raise web.HTTPError(400, f'{path} does not exist')
-            info = self.fs.info(fs_path)
-            type = info[u'kind']
+            type = 'directory' if info.type == FileType.Directory else 'file'
         if path.endswith('.ipynb'):  # fix type with notebook special case.
             type = 'notebook'
         if type == 'directory':
@@ -211,6 +297,30 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
             model = self.__get_file(path, content=content, format=format)
         return model
 
+    def update(self, model, path):
+        """Update the file's path, on the I/O pool."""
+        return self._run_blocking(self._run_locked, (path, model.get('path', path)), super().update, model, path)
+
+    def delete(self, path):
+        """Delete a file/directory and its checkpoints, on the I/O pool."""
+        return self._run_blocking(self._run_locked, (path,), super().delete, path)
+
+    def create_checkpoint(self, path):
+        """Create a checkpoint, on the I/O pool."""
+        return self._run_blocking(self._run_locked, (path,), super().create_checkpoint, path)
+
+    def restore_checkpoint(self, checkpoint_id, path):
+        """Restore a checkpoint, on the I/O pool."""
+        return self._run_blocking(self._run_locked, (path,), super().restore_checkpoint, checkpoint_id, path)
+
+    def list_checkpoints(self, path):
+        """List the checkpoints of a file, on the I/O pool."""
+        return self._run_blocking(super().list_checkpoints, path)
+
+    def delete_checkpoint(self, checkpoint_id, path):
+        """Delete a checkpoint, on the I/O pool."""
+        return self._run_blocking(super().delete_checkpoint, checkpoint_id, path)
+
     def save(self, model, path):
         """
         Save a file or directory model to path.
@@ -218,32 +328,57 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
         Should return the saved model with no content.  Save implementations
         should call self.run_pre_save_hook(model=model, path=path) prior to
         writing any data.
+
+        HDFS operations run on the I/O pool and a future of the model is returned.
+        Notebooks are signed beforehand on the calling thread, as the notary's
+        database cannot be shared across threads.
         """
-        self._ensure_path_is_valid(path)
         if 'type' not in model:
             raise web.HTTPError(400, u'No file type provided')
         if 'content' not in model and model['type'] != 'directory':
             raise web.HTTPError(400, u'No file content provided')
+        # Rejected before the hook runs, the remaining checks need HDFS and run with the write.
+        if self.is_hidden(path):
+            raise web.HTTPError(400, f'Invalid hidden file/directory: {path}')
         self.run_pre_save_hook(model=model, path=path)
-        try:
-            if model['type'] == 'notebook':
+        nb = None
+        if model['type'] == 'notebook':
+            try:
                 nb = nbformat.from_dict(model['content'])
                 self.check_and_sign(nb, path)
-                self._save_notebook(path, nb)
+            except Exception as e:
+                raise web.HTTPError(500, f'Unexpected error while saving file: {path} {e}')
+        return self._run_blocking(self._save, model, path, nb)
+
+    def _save(self, model, path, nb=None):
+        """Write a model prepared by save() to path and return it with no content."""
+        with self._path_lock(path):
+            return self.__write_model(model, path, nb)
+
+    def __write_model(self, model, path, nb):
+        """Write model to path, under the lock of path."""
+        self._ensure_path_is_valid(path, model['type'])
+        try:
+            if model['type'] == 'notebook':
+                self._save_notebook(path, nb, _validated=True)
+                # The path may have been cached as missing by the validation above.
+                self._invalidate_info(self._to_fs_path(path))
                 # One checkpoint should always exist for notebooks.
                 if not self.checkpoints.list_checkpoints(path):
                     self.create_checkpoint(path)
             elif model['type'] == 'file':
                 # Missing format will be handled internally by _save_file.
-                self._save_file(path, model['content'], model.get('format'))
+                self._save_file(path, model['content'], model.get('format'), _validated=True)
             elif model['type'] == 'directory':
-                self._save_directory(path)
+                self._save_directory(path, _validated=True)
             else:
                 raise web.HTTPError(400, f"Unhandled content type: {model['type']}")
         except web.HTTPError:
             raise
         except Exception as e:
             raise web.HTTPError(500, f'Unexpected error while saving file: {path} {e}')
+        finally:
+            self._invalidate_info(self._to_fs_path(path))
         validation_message = None
         if model['type'] == 'notebook':
             self.validate_notebook_model(model)
@@ -255,35 +390,38 @@ class HDFSContentsManager(HDFSManagerMixin, ContentsManager):
 
     def delete_file(self, path):
         """Delete the file or directory at path."""
-        if not self.exists(path):
+        fs_path = self._to_fs_path(path)
+        info = self._stat(fs_path)
+        if info is None:
             raise web.HTTPError(404, f'File or directory does not exist: {path}')
         if self.is_hidden(path):
             raise web.HTTPError(400, f'Invalid hidden file/directory: {path}')
-        fs_path = self._to_fs_path(path)
-        if self.fs.isfile(fs_path):
+        if info.type == FileType.File:
             with self.perm_to_403():
-                self.fs.delete(fs_path)
+                self.fs.delete_file(fs_path)
         else:
-            if len(self.fs.ls(fs_path)) > 0:
+            if len(self.fs.get_file_info(FileSelector(fs_path))) > 0:
                 raise web.HTTPError(400, f'Directory not empty: {path}')
             else:
                 with self.perm_to_403():
-                    self.fs.delete(fs_path)
+                    self.fs.delete_dir(fs_path)
+        self._invalidate_info(fs_path)
 
     def rename_file(self, old_path, new_path):
         """Rename a file or directory."""
-        if not self.exists(old_path):
+        old_fs_path = self._to_fs_path(old_path)
+        new_fs_path = self._to_fs_path(new_path)
+        if self._stat(old_fs_path) is None:
             raise web.HTTPError(404, f'File or directory does not exist: {old_path}')
         if self.is_hidden(old_path):
             raise web.HTTPError(400, f'Invalid hidden file/directory: {old_path}')
-        if self.exists(new_path):
+        if self._stat(new_fs_path) is not None:
             raise web.HTTPError(404, f'File or directory already exist: {new_path}')
         if self.is_hidden(new_path):
             raise web.HTTPError(400, f'Invalid hidden file/directory: {new_path}')
-        old_fs_path = self._to_fs_path(old_path)
-        new_fs_path = self._to_fs_path(new_path)
         with self.perm_to_403():
-            self.fs.rename(old_fs_path, new_fs_path)
+            self.fs.move(old_fs_path, new_fs_path)
+        self._invalidate_info(old_fs_path, new_fs_path)
 
     def info_string(self):
         return f"Serving notebooks from HDFS directory: {self.root_dir}"
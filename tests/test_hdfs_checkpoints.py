@@ -0,0 +1,44 @@
+import pytest
+from nbformat.v4 import new_notebook
+from pyarrow.fs import FileSystem
+from pyarrow.fs import LocalFileSystem
+from traitlets import Instance
+
+from jupyter_omnicm.hdfs.hdfs_manager import HDFSContentsManager
+
+
+class LocalContentsManager(HDFSContentsManager):
+    fs = Instance(FileSystem)
+
+
+def _result(value):
+    return value.result() if hasattr(value, 'result') else value
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return LocalContentsManager(fs=LocalFileSystem(), root_dir=str(tmp_path))
+
+
+def test_rename_checkpoint_to_another_directory(manager, tmp_path):
+    _result(manager.save({'type': 'directory'}, 'sub'))
+    _result(manager.save({'type': 'notebook', 'content': new_notebook()}, 'a.ipynb'))
+    assert manager.list_checkpoints('a.ipynb').result()
+    _result(manager.update({'path': 'sub/a.ipynb'}, 'a.ipynb'))
+    assert (tmp_path / 'sub' / '.ipynb_checkpoints' / 'a-checkpoint.ipynb').is_file()
+    assert not (tmp_path / '.ipynb_checkpoints' / 'a-checkpoint.ipynb').exists()
+    assert [cp['id'] for cp in manager.list_checkpoints('sub/a.ipynb').result()] == ['checkpoint']
+
+
+def test_rename_without_checkpoint(manager, tmp_path):
+    _result(manager.save({'type': 'file', 'format': 'text', 'content': 'text'}, 'a.txt'))
+    _result(manager.update({'path': 'b.txt'}, 'a.txt'))
+    assert (tmp_path / 'b.txt').read_text() == 'text'
+    assert manager.list_checkpoints('b.txt').result() == []
+
+
+def test_restore_missing_checkpoint_keeps_file(manager, tmp_path):
+    _result(manager.save({'type': 'file', 'format': 'text', 'content': 'text'}, 'a.txt'))
+    with pytest.raises(FileNotFoundError):
+        _result(manager.restore_checkpoint('checkpoint', 'a.txt'))
+    assert (tmp_path / 'a.txt').read_text() == 'text'
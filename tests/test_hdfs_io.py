@@ -0,0 +1,66 @@
+from base64 import b64encode
+from base64 import encodebytes
+
+import nbformat
+import pytest
+from nbformat.v4 import new_notebook
+from pyarrow.fs import FileSystem
+from pyarrow.fs import LocalFileSystem
+from tornado.web import HTTPError
+from traitlets import Instance
+from traitlets import Unicode
+
+from jupyter_omnicm.hdfs.hdfs_io import HDFSManagerMixin
+from jupyter_omnicm.hdfs.hdfs_io import _iter_b64decode
+
+
+class LocalManager(HDFSManagerMixin):
+    fs = Instance(FileSystem)
+    root_dir = Unicode()
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return LocalManager(fs=LocalFileSystem(), root_dir=str(tmp_path))
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 3, 1000, 4099])
+@pytest.mark.parametrize('chunk_size', [4, 8, 76, 1024])
+def test_iter_b64decode(size, chunk_size):
+    data = bytes(range(256)) * (size // 256) + bytes(range(size % 256))
+    for encoded in (b64encode(data), encodebytes(data)):
+        assert b''.join(_iter_b64decode(encoded.decode('ascii'), chunk_size)) == data
+
+
+def test_save_large_base64_file(manager, tmp_path, monkeypatch):
+    monkeypatch.setattr('jupyter_omnicm.hdfs.hdfs_io.B64_DECODE_CHUNK_SIZE', 8)
+    data = b'large upload content'
+    manager._save_file('upload.bin', b64encode(data).decode('ascii'), 'base64', _validated=True)
+    assert (tmp_path / 'upload.bin').read_bytes() == data
+    assert [p.name for p in tmp_path.iterdir()] == ['upload.bin']
+
+
+def test_save_invalid_large_base64_keeps_existing_file(manager, tmp_path, monkeypatch):
+    monkeypatch.setattr('jupyter_omnicm.hdfs.hdfs_io.B64_DECODE_CHUNK_SIZE', 8)
+    (tmp_path / 'upload.bin').write_bytes(b'previous content')
+    content = b64encode(b'valid start of the upload').decode('ascii') + 'A'
+    with pytest.raises(HTTPError) as excinfo:
+        manager._save_file('upload.bin', content, 'base64', _validated=True)
+    assert excinfo.value.status_code == 400
+    assert (tmp_path / 'upload.bin').read_bytes() == b'previous content'
+    assert [p.name for p in tmp_path.iterdir()] == ['upload.bin']
+
+
+def test_read_bytes_ignores_cached_size(manager, tmp_path):
+    fs_path = str(tmp_path / 'data.txt')
+    (tmp_path / 'data.txt').write_bytes(b'short')
+    assert manager._info_cached(fs_path).size == 5
+    (tmp_path / 'data.txt').write_bytes(b'much longer content')
+    assert manager._read_bytes(fs_path) == b'much longer content'
+
+
+def test_save_notebook_ends_with_newline(manager, tmp_path):
+    manager._save_notebook('test.ipynb', new_notebook(), _validated=True)
+    content = (tmp_path / 'test.ipynb').read_text()
+    assert content.endswith('}\n')
+    assert nbformat.reads(content, as_version=4) == new_notebook()
@@ -0,0 +1,25 @@
+import pytest
+from pyarrow.fs import FileSystem
+from pyarrow.fs import LocalFileSystem
+from tornado.web import HTTPError
+from traitlets import Instance
+
+from jupyter_omnicm.hdfs.hdfs_manager import HDFSContentsManager
+
+
+class LocalContentsManager(HDFSContentsManager):
+    fs = Instance(FileSystem)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return LocalContentsManager(fs=LocalFileSystem(), root_dir=str(tmp_path))
+
+
+def test_save_hidden_path_skips_pre_save_hook(manager):
+    calls = []
+    manager.pre_save_hook = lambda **kwargs: calls.append(kwargs['path'])
+    with pytest.raises(HTTPError) as excinfo:
+        manager.save({'type': 'file', 'format': 'text', 'content': 'text'}, '.hidden.txt')
+    assert excinfo.value.status_code == 400
+    assert calls == []